@@ -29,6 +29,18 @@ DEFAULT_SPEED_LIMIT_MPH = {
 }
 
 
+class _BudgetExceeded:
+    """
+    Sentinel returned by find_path when a search runs out of budget before it
+    either reaches the destination or proves that no path exists.
+    """
+    def __repr__(self):
+        return 'BUDGET_EXCEEDED'
+
+
+BUDGET_EXCEEDED = _BudgetExceeded()
+
+
 
 
 
@@ -87,19 +99,35 @@ def find_nearest_node(loc, aux_structures):
     return n1
 
 
-def find_path(aux_structures, loc1, loc2, short=True):
+def find_path(aux_structures, loc1, loc2, short=True, max_expanded=None, should_stop=None,
+              nodes=None):
     '''
     Finds a path from loc1 to loc2.
+
+    max_expanded caps the number of nodes the search may expand, and
+    should_stop is an optional zero-argument callable (used for deadlines and
+    cancellation) that is checked before every expansion. If either limit is
+    hit, BUDGET_EXCEEDED is returned instead of a path or None.
+
+    Callers that have already snapped the locations to nodes can pass them
+    as nodes=(start_node, end_node).
     '''
 
 
-    n1 = find_nearest_node(loc1, aux_structures)
-    n2 = find_nearest_node(loc2, aux_structures)
+    if nodes is not None:
+        n1, n2 = nodes
+    else:
+        n1 = find_nearest_node(loc1, aux_structures)
+        n2 = find_nearest_node(loc2, aux_structures)
     agenda = [[0, 0, [n1]]]
 
     visited = set()
 
     while agenda:
+        if max_expanded is not None and len(visited) >= max_expanded:
+            return BUDGET_EXCEEDED
+        if should_stop is not None and should_stop():
+            return BUDGET_EXCEEDED
         if short:
             agenda = sorted(agenda, key=lambda x: x[0])
         else:
@@ -139,7 +167,7 @@ def find_path(aux_structures, loc1, loc2, short=True):
 
 
 
-def find_short_path(aux_structures, loc1, loc2):
+def find_short_path(aux_structures, loc1, loc2, max_expanded=None, should_stop=None):
     """
     Return the shortest path between the two locations
 
@@ -149,17 +177,22 @@ def find_short_path(aux_structures, loc1, loc2):
               location
         loc2: tuple of 2 floats: (latitude, longitude), representing the end
               location
+        max_expanded: optional cap on the number of nodes the search expands
+        should_stop: optional zero-argument callable; the search gives up as
+                     soon as it returns True (deadlines, cancellation)
 
     Returns:
         a list of (latitude, longitude) tuples representing the shortest path
-        (in terms of distance) from loc1 to loc2.
+        (in terms of distance) from loc1 to loc2, None if no such path
+        exists, or BUDGET_EXCEEDED if a limit was hit first.
     """
-    return find_path(aux_structures, loc1, loc2)
+    return find_path(aux_structures, loc1, loc2,
+                     max_expanded=max_expanded, should_stop=should_stop)
 
 
 
 
-def find_fast_path(aux_structures, loc1, loc2):
+def find_fast_path(aux_structures, loc1, loc2, max_expanded=None, should_stop=None):
     """
     Return the shortest path between the two locations, in terms of expected
     time (taking into account speed limits).
@@ -170,12 +203,17 @@ def find_fast_path(aux_structures, loc1, loc2):
               location
         loc2: tuple of 2 floats: (latitude, longitude), representing the end
               location
+        max_expanded: optional cap on the number of nodes the search expands
+        should_stop: optional zero-argument callable; the search gives up as
+                     soon as it returns True (deadlines, cancellation)
 
     Returns:
         a list of (latitude, longitude) tuples representing the shortest path
-        (in terms of time) from loc1 to loc2.
+        (in terms of time) from loc1 to loc2, None if no such path exists,
+        or BUDGET_EXCEEDED if a limit was hit first.
     """
-    return find_path(aux_structures, loc1, loc2, short=False)
+    return find_path(aux_structures, loc1, loc2, short=False,
+                     max_expanded=max_expanded, should_stop=should_stop)
 
 
 if __name__ == '__main__':
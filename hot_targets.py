@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Precomputed reverse shortest-path trees for popular destinations.
+
+A tree for a target node maps every node that can reach the target to its
+cost-to-target and the next node on the best path, so a route from any source
+to that target is just a walk along those pointers.
+"""
+
+import sys
+import heapq
+import queue
+import threading
+
+from util import great_circle_distance
+
+
+def reverse_web(node_web):
+    """
+    Returns node_web with every edge reversed: node_id mapped to the nodes
+    that have an edge into it (and that edge's speed limit).
+    """
+    reverse = {node: {} for node in node_web}
+    for node, children in node_web.items():
+        for child, speed in children.items():
+            reverse.setdefault(child, {})[node] = speed
+    return reverse
+
+
+def build_reverse_tree(aux_structures, target, short=True, reverse=None):
+    """
+    Runs Dijkstra backwards from target over the road graph.
+
+    Parameters:
+        aux_structures: the result of calling build_auxiliary_structures
+        target: node id of the destination
+        short: True to minimize distance, False to minimize expected time
+        reverse: optionally, reverse_web(aux_structures[0]), so that several
+                 trees can share the work of building it
+
+    Returns:
+        a dictionary mapping each node that can reach target to a tuple
+        (cost to target, next node towards target); the target itself maps
+        to (0, None).
+    """
+    node_coord = aux_structures[1]
+    if reverse is None:
+        reverse = reverse_web(aux_structures[0])
+
+    tree = {}
+    agenda = [(0, target, None)]
+    while agenda:
+        cost, node, next_node = heapq.heappop(agenda)
+        if node in tree:
+            continue
+        tree[node] = (cost, next_node)
+        for parent, speed in reverse.get(node, {}).items():
+            if parent not in tree:
+                d = great_circle_distance(node_coord[parent], node_coord[node])
+                heapq.heappush(agenda, (cost + (d if short else d / speed), parent, node))
+    return tree
+
+
+def path_from_tree(aux_structures, tree, source):
+    """
+    Walks the parent pointers of a reverse tree from source to its target.
+    Returns a list of (latitude, longitude) tuples, or None if source cannot
+    reach the target.
+    """
+    if source not in tree:
+        return None
+    node_coord = aux_structures[1]
+    path = []
+    node = source
+    while node is not None:
+        path.append(node_coord[node])
+        node = tree[node][1]
+    return path
+
+
+def tree_size(tree):
+    """
+    Rough estimate, in bytes, of the memory held by a reverse tree.
+    """
+    if not tree:
+        return sys.getsizeof(tree)
+    cost, next_node = next(iter(tree.values()))
+    per_entry = sys.getsizeof((cost, next_node)) + sys.getsizeof(1.0)
+    return sys.getsizeof(tree) + len(tree) * per_entry
+
+
+class HotTargetCache:
+    """
+    Keeps reverse shortest-path trees, for both metrics, for a set of hot
+    target nodes.  Targets are either configured up front or promoted once
+    they have been asked for auto_threshold times.  Trees are built on a
+    background thread; until a tree is ready, lookup returns None and the
+    caller should fall back to a normal search.
+
+    All trees count against memory_budget.  When a target's pair of trees
+    does not fit, less popular auto-detected targets are dropped to make room,
+    or the new target is turned away if that is not enough; configured
+    targets are always kept.  A dropped target can be promoted again once it
+    is requested more often than the least popular cached auto target.
+
+    Request counts are kept for at most max_tracked destinations; beyond
+    that, all counts are halved and the ones that reach zero are forgotten.
+    """
+    def __init__(self, aux_structures, targets=(), memory_budget=256 * 2**20,
+                 auto_threshold=50, max_auto_targets=16, max_tracked=10000):
+        self.memory_budget = memory_budget
+        self.auto_threshold = auto_threshold
+        self.max_auto_targets = max_auto_targets
+        self.max_tracked = max_tracked
+
+        self.lock = threading.Lock()
+        self.aux = aux_structures
+        self.generation = 0
+        self.closed = False
+        self.pinned = set(targets)    # configured targets, never evicted
+        self.auto = set()             # targets promoted by popularity
+        self.demoted = set()          # auto targets that were evicted or did not fit
+        self.counts = {}              # target node -> number of lookups
+        self.trees = {}               # (target, short) -> tree
+        self.sizes = {}               # (target, short) -> tree_size(tree)
+        self.memory_used = 0
+        self.hits = self.misses = self.builds = self.rejected = 0
+
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+        for target in self.pinned:
+            self._schedule(target)
+
+    def lookup(self, target, short=True):
+        """
+        Returns the ready tree for target under the given metric, or None.
+        Also counts the request towards auto-detecting popular targets.
+        """
+        with self.lock:
+            count = self.counts[target] = self.counts.get(target, 0) + 1
+            if len(self.counts) > self.max_tracked:
+                self._decay()
+            tree = self.trees.get((target, short))
+            if tree is not None:
+                self.hits += 1
+                return tree
+            self.misses += 1
+            promote = (count >= self.auto_threshold
+                       and target not in self.pinned and target not in self.auto
+                       and (target not in self.demoted or self._may_return(count))
+                       and len(self.auto) < self.max_auto_targets)
+            if promote:
+                self.auto.add(target)
+                self.demoted.discard(target)
+        if promote:
+            self._schedule(target)
+        return None
+
+    def set_graph(self, aux_structures, targets=None):
+        """
+        Replaces the graph (and, if given, the configured targets).  Trees for
+        the old graph are dropped at once and rebuilt in the background;
+        lookups miss until they are ready.
+        """
+        with self.lock:
+            self.aux = aux_structures
+            if targets is not None:
+                self.pinned = set(targets)
+                self.auto -= self.pinned
+            self.generation += 1
+            self.trees = {}
+            self.sizes = {}
+            self.memory_used = 0
+            self.demoted = set()
+            targets = self.pinned | self.auto
+        for target in targets:
+            self._schedule(target)
+
+    def join(self):
+        """
+        Blocks until every build scheduled so far has finished.
+        """
+        self.jobs.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'targets': len(self.pinned | self.auto),
+                'trees': len(self.trees),
+                'memory_used': self.memory_used,
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'builds': self.builds,
+                'rejected': self.rejected,
+                'pending': self.jobs.qsize(),
+            }
+
+    def close(self):
+        """
+        Stops the background worker.  Builds that are still queued are
+        skipped, and a build in progress is thrown away when it finishes.
+        """
+        with self.lock:
+            self.closed = True
+            self.generation += 1
+        self.jobs.put(None)
+
+    def _schedule(self, target):
+        with self.lock:
+            generation = self.generation
+        self.jobs.put((generation, target))
+
+    def _work(self):
+        # the reversed graph is as big as the graph itself, so it is only
+        # kept while there are builds waiting to use it
+        reverse = reverse_generation = None
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                generation, target = job
+                with self.lock:
+                    aux = self.aux
+                    if self.closed or generation != self.generation:
+                        continue  # closed, or a newer job for this target is queued
+                if target not in aux[0]:
+                    continue
+                if reverse_generation != generation:
+                    reverse = reverse_web(aux[0])
+                    reverse_generation = generation
+                trees = {True: build_reverse_tree(aux, target, True, reverse)}
+                # the other metric's tree has the same nodes, so it is about
+                # the same size; don't build it if the pair can't fit
+                if not self._fits(generation, target, 2 * tree_size(trees[True])):
+                    continue
+                trees[False] = build_reverse_tree(aux, target, False, reverse)
+                self._store(generation, target, trees)
+            finally:
+                if self.jobs.empty():
+                    reverse = reverse_generation = None
+                self.jobs.task_done()
+
+    def _fits(self, generation, target, size):
+        # returns False (and demotes target) if size bytes of trees for
+        # target cannot be made to fit in the budget
+        with self.lock:
+            if generation != self.generation:
+                return False
+            if self._room_for(target, size) is None:
+                self.rejected += 1
+                self._demote(target)
+                return False
+            return True
+
+    def _store(self, generation, target, trees):
+        # trees maps short -> tree for target; evicts less popular auto
+        # targets as needed, and returns False if the trees were thrown away
+        sizes = {short: tree_size(tree) for short, tree in trees.items()}
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.builds += len(trees)
+            self._drop(target)
+            victims = self._room_for(target, sum(sizes.values()))
+            if victims is None:
+                self.rejected += 1
+                self._demote(target)
+                return False
+            for victim in victims:
+                self._demote(victim)
+            for short, tree in trees.items():
+                self.trees[(target, short)] = tree
+                self.sizes[(target, short)] = sizes[short]
+                self.memory_used += sizes[short]
+            return True
+
+    def _room_for(self, target, size):
+        # called with the lock held.  returns the auto targets to evict so
+        # that size more bytes fit in the budget (only ones less popular than
+        # target qualify), or None if that is not enough.  configured targets
+        # always get room.
+        needed = self.memory_used + size - self.memory_budget
+        if needed <= 0:
+            return []
+        popularity = self.counts.get(target, 0)
+        candidates = sorted((t for t in self.auto
+                             if t != target and self._target_size(t)
+                             and self.counts.get(t, 0) < popularity),
+                            key=lambda t: self.counts.get(t, 0))
+        victims = []
+        freed = 0
+        for victim in candidates:
+            if freed >= needed:
+                break
+            victims.append(victim)
+            freed += self._target_size(victim)
+        if freed < needed and target not in self.pinned:
+            return None
+        return victims
+
+    def _target_size(self, target):
+        # called with the lock held
+        return sum(self.sizes.get((target, short), 0) for short in (True, False))
+
+    def _drop(self, target):
+        # called with the lock held; forgets whatever trees target has
+        for short in (True, False):
+            if (target, short) in self.trees:
+                del self.trees[(target, short)]
+                self.memory_used -= self.sizes.pop((target, short))
+
+    def _demote(self, target):
+        # called with the lock held
+        self._drop(target)
+        self.auto.discard(target)
+        self.demoted.add(target)
+
+    def _decay(self):
+        # called with the lock held
+        self.counts = {target: count // 2 for target, count in self.counts.items()
+                       if count > 1}
+        self.demoted &= self.counts.keys()
+
+    def _may_return(self, count):
+        # called with the lock held.  a demoted target comes back once it is
+        # asked for more often than the least popular cached auto target
+        cached = [self.counts.get(t, 0) for t in self.auto if self._target_size(t)]
+        return bool(cached) and count > min(cached)
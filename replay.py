@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Replays a JSONL query log (as written by the server when MAPS_QUERY_LOG is
+set) against a running server or directly against the library functions, and
+reports throughput and latency percentiles.
+
+examples:
+  python3 replay.py queries.jsonl --url http://localhost:6009 --concurrency 4
+  python3 replay.py queries.jsonl --local --rate 20
+  python3 replay.py queries.jsonl --dataset cambridge
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_queries(filename, limit=None):
+    """
+    Loads the queries from a JSONL log, skipping blank or malformed lines.
+    """
+    queries = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                queries.append({
+                    'type': 'fast' if record.get('type') == 'fast' else 'short',
+                    'start': tuple(record['start']),
+                    'end': tuple(record['end']),
+                    'dataset': record.get('dataset'),
+                    'latency': record.get('latency'),
+                })
+            except (ValueError, KeyError, TypeError):
+                continue
+            if limit is not None and len(queries) >= limit:
+                break
+    return queries
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0 <= p <= 100) of values, using the
+    nearest-rank method.  values must be sorted.
+    """
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def make_http_runner(url, timeout):
+    """
+    Returns a function that sends one query to the server at url and returns
+    the outcome ('ok', 'no_path', 'budget_exceeded' or 'error').
+    """
+    route_url = url.rstrip('/') + '/route'
+
+    def run(query):
+        body = json.dumps({
+            'type': query['type'],
+            'startLat': query['start'][0], 'startLon': query['start'][1],
+            'endLat': query['end'][0], 'endLon': query['end'][1],
+        }).encode('utf-8')
+        request = urllib.request.Request(
+            route_url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            out = json.loads(response.read())
+        if out.get('ok'):
+            return 'ok'
+        return 'budget_exceeded' if out.get('budget_exceeded') else 'no_path'
+    return run
+
+
+def make_library_runner(default_dataset=None):
+    """
+    Returns a function that answers one query in-process using the library
+    functions, on the dataset recorded with the query or else on
+    default_dataset.  Each dataset is loaded the first time it is needed.
+    """
+    from MapsApp import (find_short_path, find_fast_path,
+                         build_auxiliary_structures, BUDGET_EXCEEDED)
+
+    graphs = {}
+    lock = threading.Lock()
+
+    def get_aux(dataset):
+        with lock:
+            if dataset not in graphs:
+                print(f'building auxiliary structures for {dataset}...', file=sys.stderr)
+                t = time.time()
+                graphs[dataset] = build_auxiliary_structures(
+                    f'resources/{dataset}.nodes', f'resources/{dataset}.ways')
+                print('auxiliary structures built in %.02f seconds.' % (time.time() - t,),
+                      file=sys.stderr)
+            return graphs[dataset]
+
+    def run(query):
+        dataset = query.get('dataset') or default_dataset
+        if dataset is None:
+            return 'error'
+        aux = get_aux(dataset)
+        func = find_fast_path if query['type'] == 'fast' else find_short_path
+        route = func(aux, query['start'], query['end'])
+        if route is BUDGET_EXCEEDED:
+            return 'budget_exceeded'
+        return 'no_path' if route is None else 'ok'
+    return run
+
+
+def replay(queries, run, concurrency=1, rate=None):
+    """
+    Runs every query through run using concurrency worker threads.  If rate
+    is given, queries are started at no more than rate per second.
+
+    Returns (latencies, outcomes, elapsed) where latencies is a list of
+    per-query latencies in seconds and outcomes maps outcome names to counts.
+    With a rate, each latency is measured from the moment the query was
+    scheduled to start, so time spent waiting for a free worker is included
+    rather than hidden.
+    """
+    latencies = []
+    outcomes = {}
+    lock = threading.Lock()
+
+    def timed(query, scheduled):
+        t = time.perf_counter() if scheduled is None else scheduled
+        try:
+            outcome = run(query)
+        except Exception:
+            outcome = 'error'
+        latency = time.perf_counter() - t
+        with lock:
+            latencies.append(latency)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, query in enumerate(queries):
+            scheduled = None
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(timed, query, scheduled)
+    elapsed = time.perf_counter() - start
+    return latencies, outcomes, elapsed
+
+
+def report(queries, latencies, outcomes, elapsed, out=sys.stdout):
+    """
+    Prints throughput and latency percentiles for a replay, alongside the
+    latencies recorded in the log when it has them.
+    """
+    latencies = sorted(latencies)
+    print('queries:     %d' % len(latencies), file=out)
+    print('outcomes:    %s' % ', '.join(f'{k}={v}' for k, v in sorted(outcomes.items())), file=out)
+    print('elapsed:     %.3f s' % elapsed, file=out)
+    if elapsed > 0:
+        print('throughput:  %.2f queries/s' % (len(latencies) / elapsed), file=out)
+    recorded = sorted(q['latency'] for q in queries if q.get('latency') is not None)
+    for p in (50, 90, 99, 100):
+        label = 'max' if p == 100 else f'p{p}'
+        line = '%-12s %.2f ms' % (label + ':', percentile(latencies, p) * 1000)
+        if recorded:
+            line += '  (logged %.2f ms)' % (percentile(recorded, p) * 1000)
+        print(line, file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay a route query log')
+    parser.add_argument('log', help='JSONL query log to replay')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='base URL of a running server, e.g. http://localhost:6009')
+    target.add_argument('--local', action='store_true',
+                        help='run queries in-process, on the dataset recorded with each query')
+    target.add_argument('--dataset',
+                        help='run queries in-process, using this dataset for queries that '
+                             'do not record one')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of queries in flight')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='maximum queries started per second (default: unlimited)')
+    parser.add_argument('--limit', type=int, default=None, help='only replay the first N queries')
+    parser.add_argument('--timeout', type=float, default=60.0, help='per-request HTTP timeout')
+    args = parser.parse_args(argv)
+
+    queries = read_queries(args.log, args.limit)
+    if not queries:
+        print(f'no queries found in {args.log}', file=sys.stderr)
+        return 1
+
+    if args.url:
+        run = make_http_runner(args.url, args.timeout)
+    else:
+        run = make_library_runner(args.dataset)
+
+    latencies, outcomes, elapsed = replay(queries, run, args.concurrency, args.rate)
+    report(queries, latencies, outcomes, elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,50 +2,383 @@ import os
 import sys
 import json
 import time
+import glob
 import pickle
+import atexit
+import select
+import signal
+import socket
 import mimetypes
+import collections
 
 from wsgiref.handlers import read_environ
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
 from util import to_kml, read_osm_data
-from lab import find_short_path, find_fast_path, build_auxiliary_structures
-
-try:
-    dataset = sys.argv[1]
-except IndexError:
-    print('please provide the name of a dataset to use', file=sys.stderr)
-    print('example:', file=sys.stderr)
-    print('  python3 server.py cambridge', file=sys.stderr)
-    sys.exit(1)
+from MapsApp import find_path, find_nearest_node, build_auxiliary_structures, BUDGET_EXCEEDED
+from hot_targets import HotTargetCache, path_from_tree
 
 cur_dir = os.path.realpath(os.path.dirname(__file__))
 app_root = os.path.join(cur_dir, 'kml_viewer')
 data_root = os.path.join(cur_dir, 'resources')
 
-bounds_filename = os.path.join(data_root, f'{dataset}.bounds')
-nodes_filename = os.path.join(data_root, f'{dataset}.nodes')
-ways_filename = os.path.join(data_root, f'{dataset}.ways')
+# graphs are loaded on first use and the least recently used ones are dropped
+# once their estimated total size goes over this many megabytes.
+MEMORY_CEILING = float(os.environ.get('MAPS_MEMORY_CEILING_MB', 2048)) * 2**20
+
+
+def env_limit(name, default, type_):
+    """
+    Reads a search limit from the environment; 'none' or 0 disables it.
+    Anything else that is not a positive number is reported and ignored.
+    """
+    value = os.environ.get(name, '').strip().lower()
+    if not value:
+        return default
+    if value == 'none':
+        return None
+    try:
+        limit = type_(value)
+    except ValueError:
+        limit = None
+    if limit == 0:
+        return None
+    if limit is None or not limit > 0:
+        print(f'{name} must be a positive number, 0 or "none", not {value!r}; '
+              f'using {default}', file=sys.stderr)
+        return default
+    return limit
+
+
+# per-endpoint search limits.  max_expanded caps the number of nodes a single
+# query may expand (MAPS_ROUTE_MAX_EXPANDED), timeout is a wall-clock deadline
+# in seconds (MAPS_ROUTE_TIMEOUT_S).  either may be None to disable it.
+ROUTE_MAX_EXPANDED = env_limit('MAPS_ROUTE_MAX_EXPANDED', 200000, int)
+ROUTE_TIMEOUT = env_limit('MAPS_ROUTE_TIMEOUT_S', 5.0, float)
+QUERY_LIMITS = {
+    '/route': {
+        'short': {'max_expanded': ROUTE_MAX_EXPANDED, 'timeout': ROUTE_TIMEOUT},
+        'fast': {'max_expanded': ROUTE_MAX_EXPANDED, 'timeout': ROUTE_TIMEOUT},
+    },
+}
+
+# how often (in search expansions) to poll the client socket for a disconnect
+DISCONNECT_CHECK_INTERVAL = 256
+
+
+# set MAPS_QUERY_LOG to a filename to append every /route query to it as one
+# JSON object per line; replay.py can drive a server from such a log.
+QUERY_LOG_FILENAME = os.environ.get('MAPS_QUERY_LOG')
+QUERY_LOG_FLUSH_LINES = 256      # flush after this many buffered queries...
+QUERY_LOG_FLUSH_SECONDS = 5.0    # ...or once the oldest one is this old
+
+
+class QueryLog:
+    """
+    Append-only JSONL query log.  Records are buffered in memory and written
+    out in batches so that logging adds next to nothing to request latency.
+    The server calls flush_if_stale between requests so that records do not
+    sit in the buffer while it is idle.
+    """
+    def __init__(self, filename, flush_lines=QUERY_LOG_FLUSH_LINES,
+                 flush_seconds=QUERY_LOG_FLUSH_SECONDS):
+        self.filename = filename
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.first_buffered = None
+        self.file = open(filename, 'a', encoding='utf-8')
+
+    def append(self, record):
+        now = time.monotonic()
+        if not self.buffer:
+            self.first_buffered = now
+        self.buffer.append(json.dumps(record, separators=(',', ':')))
+        if len(self.buffer) >= self.flush_lines:
+            self.flush()
+        else:
+            self.flush_if_stale(now)
+
+    def flush_if_stale(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.buffer and now - self.first_buffered >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# destinations to keep precomputed shortest-path trees for, as
+# "lat,lon;lat,lon;..." in MAPS_HOT_TARGETS.  other destinations are promoted
+# automatically once they have been requested HOT_TARGET_THRESHOLD times.
+HOT_TARGET_LOCATIONS = [
+    tuple(float(x) for x in loc.split(','))
+    for loc in os.environ.get('MAPS_HOT_TARGETS', '').split(';') if loc.strip()
+]
+HOT_TARGET_THRESHOLD = 50
+HOT_TARGET_MAX_AUTO = 16
+HOT_TARGET_MEMORY_BUDGET = 256 * 2**20  # bytes
 
-try:
-    with open(bounds_filename, 'rb') as f:
-        entry = pickle.load(f)
-    center_point = (
-        entry['minlat']*0.5 + entry['maxlat']*0.5,
-        entry['minlon']*0.5 + entry['maxlon']*0.5
-    )
-except:
-    print('could read from bounds file, using default starting position', file=sys.stderr)
-    center_point = 42.3751, -71.1053
 
+def graph_size(aux_structures):
+    """
+    Rough estimate, in bytes, of the memory held by the auxiliary structures.
+    """
+    node_web, node_coord = aux_structures
+    edges = sum(len(children) for children in node_web.values())
+    return (sys.getsizeof(node_web) + sys.getsizeof(node_coord)
+            + len(node_web) * sys.getsizeof({})
+            + edges * 2 * sys.getsizeof(2**40)
+            + len(node_coord) * (sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0)))
 
-print('building auxiliary structures...')
-t = time.time()
-AUX = build_auxiliary_structures(nodes_filename, ways_filename)
-print('auxiliary structures built in %.02f seconds.' % (time.time() - t,))
 
-with open(os.path.join(app_root, 'index.html'), 'rb') as f:
-    index_contents = f.read() % center_point
+class Dataset:
+    """
+    One region that can be served: its bounds are read eagerly, its graph
+    (and hot-target trees) only when a query first needs them.
+    """
+    def __init__(self, name, bounds, data_root=data_root):
+        self.name = name
+        self.bounds = bounds
+        self.nodes_filename = os.path.join(data_root, f'{name}.nodes')
+        self.ways_filename = os.path.join(data_root, f'{name}.ways')
+        self.aux = None
+        self.hot = None
+        self.graph_size = 0
+        self.loaded_times = None
+        self.load_time = None
+        self.loads = 0
+        self.evictions = 0
+        self.queries = 0
+        self.last_used = None
+
+    @property
+    def center(self):
+        return (
+            self.bounds['minlat']*0.5 + self.bounds['maxlat']*0.5,
+            self.bounds['minlon']*0.5 + self.bounds['maxlon']*0.5
+        )
+
+    @property
+    def area(self):
+        return ((self.bounds['maxlat'] - self.bounds['minlat'])
+                * (self.bounds['maxlon'] - self.bounds['minlon']))
+
+    def contains(self, loc):
+        return (self.bounds['minlat'] <= loc[0] <= self.bounds['maxlat']
+                and self.bounds['minlon'] <= loc[1] <= self.bounds['maxlon'])
+
+    def memory(self):
+        if self.aux is None:
+            return 0
+        return self.graph_size + self.hot.stats()['memory_used']
+
+    def file_bytes(self):
+        try:
+            return sum(os.path.getsize(fname)
+                       for fname in (self.nodes_filename, self.ways_filename))
+        except OSError:
+            return 0
+
+    def expected_memory(self, bytes_ratio):
+        """
+        Estimates how much memory loading this dataset will take: its size
+        the last time it was loaded or, failing that, its file size scaled by
+        bytes_ratio (graph bytes per file byte).
+        """
+        if self.graph_size:
+            return self.graph_size
+        return self.file_bytes() * bytes_ratio
+
+    def file_times(self):
+        return tuple(os.path.getmtime(fname)
+                     for fname in (self.nodes_filename, self.ways_filename))
+
+    def changed(self):
+        """
+        Returns True if the graph files have changed since they were loaded.
+        """
+        try:
+            return self.aux is not None and self.file_times() != self.loaded_times
+        except OSError:
+            return False
+
+    def build(self):
+        print(f'building auxiliary structures for {self.name}...')
+        t = time.time()
+        self.loaded_times = self.file_times()
+        self.aux = build_auxiliary_structures(self.nodes_filename, self.ways_filename)
+        self.load_time = time.time() - t
+        print('auxiliary structures built in %.02f seconds.' % (self.load_time,))
+        self.graph_size = graph_size(self.aux)
+        self.loads += 1
+        return [find_nearest_node(loc, self.aux)
+                for loc in HOT_TARGET_LOCATIONS if self.contains(loc)]
+
+    def load(self):
+        targets = self.build()
+        self.hot = HotTargetCache(
+            self.aux,
+            targets=targets,
+            memory_budget=HOT_TARGET_MEMORY_BUDGET,
+            auto_threshold=HOT_TARGET_THRESHOLD,
+            max_auto_targets=HOT_TARGET_MAX_AUTO,
+        )
+
+    def reload(self):
+        """
+        Rebuilds the graph from its files; the hot-target trees are rebuilt
+        for the new graph in the background.
+        """
+        targets = self.build()
+        self.hot.set_graph(self.aux, targets)
+
+    def unload(self):
+        print(f'evicting {self.name}')
+        # don't wait for the worker: it drops any build in progress when it
+        # notices the cache is closed
+        self.hot.close()
+        self.aux = None
+        self.hot = None
+        self.evictions += 1
+
+    def stats(self):
+        return {
+            'resident': self.aux is not None,
+            'memory': self.memory(),
+            'load_time': self.load_time,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'queries': self.queries,
+            'last_used': self.last_used,
+            'hot_targets': self.hot.stats() if self.hot is not None else None,
+        }
+
+
+def discover_datasets(data_root):
+    """
+    Returns a Dataset for every <name>.bounds in data_root that has matching
+    .nodes and .ways files.
+    """
+    datasets = []
+    for bounds_filename in sorted(glob.glob(os.path.join(data_root, '*.bounds'))):
+        name = os.path.basename(bounds_filename)[:-len('.bounds')]
+        if not all(os.path.isfile(os.path.join(data_root, f'{name}.{ext}'))
+                   for ext in ('nodes', 'ways')):
+            print(f'no .nodes/.ways for {bounds_filename}, skipping it', file=sys.stderr)
+            continue
+        try:
+            with open(bounds_filename, 'rb') as f:
+                datasets.append(Dataset(name, pickle.load(f), data_root))
+        except Exception:
+            print(f'could not read {bounds_filename}, skipping it', file=sys.stderr)
+    return datasets
+
+
+class DatasetRegistry:
+    """
+    A set of datasets, with the loaded ones kept in least-recently-used order
+    so they can be evicted under memory pressure.  Room is made before a
+    dataset is loaded, based on an estimate of its size; bytes_ratio (graph
+    bytes per byte of .nodes/.ways file) starts at 1 and is updated from the
+    datasets actually loaded.
+    """
+    def __init__(self, datasets, memory_ceiling=MEMORY_CEILING):
+        self.memory_ceiling = memory_ceiling
+        self.bytes_ratio = 1.0
+        self.datasets = {ds.name: ds for ds in datasets}
+        self.resident = collections.OrderedDict()  # name -> Dataset, oldest first
+
+    def find(self, *locs):
+        """
+        Returns the smallest dataset whose bounds contain all of locs, or
+        None if there is no such dataset.
+        """
+        candidates = [d for d in self.datasets.values() if all(d.contains(loc) for loc in locs)]
+        return min(candidates, key=lambda d: d.area, default=None)
+
+    def acquire(self, ds):
+        """
+        Returns the auxiliary structures of ds, loading them if needed (or
+        reloading them if their files have changed) and evicting other
+        datasets to stay under the memory ceiling.
+        """
+        if ds.aux is None:
+            self.evict(keep=ds.name, needed=ds.expected_memory(self.bytes_ratio))
+            ds.load()
+            if ds.graph_size and ds.file_bytes():
+                self.bytes_ratio = ds.graph_size / ds.file_bytes()
+        elif ds.changed():
+            ds.reload()
+        self.resident[ds.name] = ds
+        self.resident.move_to_end(ds.name)
+        ds.last_used = time.time()
+        ds.queries += 1
+        self.evict(keep=ds.name)
+        return ds.aux
+
+    def evict(self, keep=None, needed=0):
+        """
+        Unloads least recently used datasets, other than keep, until needed
+        more bytes fit under the memory ceiling.
+        """
+        while self.memory() + needed > self.memory_ceiling:
+            victim = next((name for name in self.resident if name != keep), None)
+            if victim is None:
+                break
+            self.resident.pop(victim).unload()
+
+    def memory(self):
+        return sum(ds.memory() for ds in self.resident.values())
+
+    def stats(self):
+        return {
+            'memory': self.memory(),
+            'memory_ceiling': self.memory_ceiling,
+            'datasets': {name: ds.stats() for name, ds in self.datasets.items()},
+        }
+
+
+# set up by setup() when the server starts
+DATASETS = None
+QUERY_LOG = None
+index_contents = None
+
+
+def setup(default_dataset=None):
+    """
+    Finds the datasets, opens the query log and renders the main page.  The
+    main page is centered on default_dataset, if given.
+    """
+    global DATASETS, QUERY_LOG, index_contents
+
+    DATASETS = DatasetRegistry(discover_datasets(data_root))
+    if not DATASETS.datasets:
+        print(f'no datasets found in {data_root}', file=sys.stderr)
+        sys.exit(1)
+
+    if QUERY_LOG_FILENAME:
+        QUERY_LOG = QueryLog(QUERY_LOG_FILENAME)
+        atexit.register(QUERY_LOG.close)
+
+    if default_dataset in DATASETS.datasets:
+        center_point = DATASETS.datasets[default_dataset].center
+    elif default_dataset is None:
+        center_point = next(iter(DATASETS.datasets.values())).center
+    else:
+        print(f'unknown dataset {default_dataset!r}, using default starting position', file=sys.stderr)
+        center_point = 42.3751, -71.1053
+
+    with open(os.path.join(app_root, 'index.html'), 'rb') as f:
+        index_contents = f.read() % center_point
 
 
 def parse_post(environ):
@@ -58,22 +391,114 @@ def parse_post(environ):
     return json.loads(body)
 
 
+def client_disconnected(environ):
+    """
+    Returns True if the client that made this request has closed its end of
+    the connection.  Only works with RequestHandler, which exposes the socket.
+    """
+    conn = environ.get('maps.connection')
+    if conn is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+        if not readable:
+            return False
+        return conn.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+def make_should_stop(environ, timeout):
+    """
+    Builds the should_stop callback for a search: gives up once the deadline
+    passes or the client goes away.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    calls = [0]
+
+    def should_stop():
+        calls[0] += 1
+        if deadline is not None and time.monotonic() > deadline:
+            return True
+        if calls[0] % DISCONNECT_CHECK_INTERVAL == 0 and client_disconnected(environ):
+            environ['maps.cancelled'] = True
+            return True
+        return False
+    return should_stop
+
+
+def route_query(environ, ds, type_, loc1, loc2, limits):
+    """
+    Answers one route query against dataset ds, from a hot-target tree when
+    one is ready and by searching otherwise, and logs it if logging is on.
+    """
+    aux = DATASETS.acquire(ds)
+    t = time.perf_counter()  # loading time is reported separately, in /stats
+    start_node = find_nearest_node(loc1, aux)
+    end_node = find_nearest_node(loc2, aux)
+    tree = ds.hot.lookup(end_node, short=type_ == 'short')
+    if tree is not None:
+        route = path_from_tree(aux, tree, start_node)
+    else:
+        route = find_path(aux, loc1, loc2, short=type_ == 'short',
+                          max_expanded=limits['max_expanded'],
+                          should_stop=make_should_stop(environ, limits['timeout']),
+                          nodes=(start_node, end_node))
+    latency = time.perf_counter() - t
+    if QUERY_LOG is not None:
+        if environ.get('maps.cancelled'):
+            result = 'cancelled'
+        elif route is BUDGET_EXCEEDED:
+            result = 'budget_exceeded'
+        else:
+            result = 'no_path' if route is None else 'ok'
+        QUERY_LOG.append({
+            'time': time.time(),
+            'dataset': ds.name,
+            'type': type_,
+            'start': loc1,
+            'end': loc2,
+            'start_node': start_node,
+            'end_node': end_node,
+            'result': result,
+            'hot': tree is not None,
+            'latency': latency,
+        })
+    return route
+
+
 def application(environ, start_response):
     path = environ.get('PATH_INFO', '/') or '/'
 
     if path == '/route':
         params = parse_post(environ)
-        func = find_short_path if params.get('type', None) != 'fast' else find_fast_path
+        type_ = 'fast' if params.get('type', None) == 'fast' else 'short'
+        limits = QUERY_LIMITS[path][type_]
         loc1 = float(params['startLat']), float(params['startLon'])
         loc2 = float(params['endLat']), float(params['endLon'])
-        route = func(AUX, loc1, loc2)
-        if route is None:
-            out = {'ok': False, 'error': 'No path found.'}
+        ds = DATASETS.find(loc1, loc2)
+        if ds is None:
+            out = {'ok': False, 'error': 'No dataset covers both points.'}
         else:
-            out = {'ok': True, 'kml': to_kml(route)}
+            route = route_query(environ, ds, type_, loc1, loc2, limits)
+            if environ.get('maps.cancelled'):
+                # nobody is listening any more; don't bother building a response
+                start_response('499 CLIENT CLOSED REQUEST', [('Content-length', '0')])
+                return [b'']
+            if route is BUDGET_EXCEEDED:
+                out = {'ok': False, 'budget_exceeded': True,
+                       'error': 'Search budget exceeded.'}
+            elif route is None:
+                out = {'ok': False, 'error': 'No path found.'}
+            else:
+                out = {'ok': True, 'kml': to_kml(route)}
         body = json.dumps(out).encode('utf-8')
         type_ = 'application/json'
         status = '200 OK'
+    elif path == '/stats':
+        body = json.dumps(DATASETS.stats()).encode('utf-8')
+        type_ = 'application/json'
+        status = '200 OK'
     else:
         if path == '/':
             # main page
@@ -104,9 +529,36 @@ def application(environ, start_response):
     return [body]
 
 
+class Server(WSGIServer):
+    """
+    WSGI server that flushes the query log while it waits for requests.
+    """
+    def service_actions(self):
+        super().service_actions()
+        if QUERY_LOG is not None:
+            QUERY_LOG.flush_if_stale()
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Request handler that exposes the client socket to the application so
+    long-running searches can notice when the client disconnects.
+    """
+    def get_environ(self):
+        env = super().get_environ()
+        env['maps.connection'] = self.connection
+        return env
+
+
 if __name__ == '__main__':
+    # every resources/<name>.bounds (with matching .nodes and .ways) is served.
+    # the optional command-line argument only picks where the map starts.
+    setup(sys.argv[1] if len(sys.argv) > 1 else None)
+    # exit normally on SIGTERM so that atexit handlers (the query log) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     print('starting server.  navigate to http://localhost:6009/')
-    with make_server('', 6009, application) as httpd:
+    with make_server('', 6009, application, server_class=Server,
+                     handler_class=RequestHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 import os
 import MapsApp
+import json
+import time
 import pickle
+import replay
+import tempfile
+import hot_targets
+import socket
 import unittest
+import importlib.util
 
 TEST_DIRECTORY = os.path.dirname(__file__)
 
 
+def _load_server():
+    spec = importlib.util.spec_from_file_location(
+        'maps_server', os.path.join(TEST_DIRECTORY, 'server copy.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+server = _load_server()
+
+
 def _tuple_close(t1, t2):
     return (len(t1) == len(t2)
             and all(abs(i - j) <= 1e-9 for i, j in zip(t1, t2)))
@@ -238,5 +256,446 @@ class Test05_CambridgeFastPaths(MapsApp3Test):
         self.compare_output(inps, 5, 'fast')
 
 
+class Test06_MITSearchBudget(MapsApp3Test):
+    dataset = 'mit'
+
+    def test_00_max_expanded(self):
+        # Search stops and reports it, rather than claiming there is no path
+        loc1 = (42.355, -71.1009) # New House
+        loc2 = (42.3612, -71.092) # 34-501
+        for func in (MapsApp.find_short_path, MapsApp.find_fast_path):
+            self.assertIs(func(self.aux, loc1, loc2, max_expanded=1), MapsApp.BUDGET_EXCEEDED)
+
+    def test_01_should_stop(self):
+        loc1 = (42.355, -71.1009) # New House
+        loc2 = (42.3612, -71.092) # 34-501
+        result = MapsApp.find_short_path(self.aux, loc1, loc2, should_stop=lambda: True)
+        self.assertIs(result, MapsApp.BUDGET_EXCEEDED)
+
+    def test_02_generous_budget(self):
+        # Limits that are never reached must not change the answer
+        loc1 = (42.355, -71.1009) # New House
+        loc2 = (42.3612, -71.092) # 34-501
+        expected_path = [
+            (42.355, -71.1009), (42.3575, -71.0952), (42.3582, -71.0931),
+            (42.3592, -71.0932), (42.36, -71.0907), (42.3612, -71.092),
+        ]
+        result = MapsApp.find_short_path(self.aux, loc1, loc2, max_expanded=1000,
+                                         should_stop=lambda: False)
+        self.assertEqual(len(result), len(expected_path), 'Path lengths differ')
+        self.assertTrue(all(_tuple_close(v1, v2) for v1, v2 in zip(result, expected_path)))
+
+    def test_03_unreachable_within_budget(self):
+        # A search that exhausts the graph still returns None
+        loc1 = (42.3575, -71.0956) # Parking Lot - end of a oneway and not on any other way
+        loc2 = (42.3575, -71.0940) #close to Kresge
+        self.assertIsNone(MapsApp.find_short_path(self.aux, loc1, loc2, max_expanded=1000))
+
+
+class Test07_MITHotTargets(MapsApp3Test):
+    dataset = 'mit'
+
+    def tree_path(self, loc1, loc2, short):
+        n1 = MapsApp.find_nearest_node(loc1, self.aux)
+        n2 = MapsApp.find_nearest_node(loc2, self.aux)
+        tree = hot_targets.build_reverse_tree(self.aux, n2, short)
+        return hot_targets.path_from_tree(self.aux, tree, n1)
+
+    def test_00_matches_search(self):
+        # Walking a reverse tree gives the same routes as searching
+        pairs = [
+            ((42.355, -71.1009), (42.3612, -71.092)), # New House, 34-501
+            ((42.3576, -71.0952), (42.355, -71.1009)), # Kresge, New House
+            ((42.36, -71.0907), (42.3592, -71.0932)), # Lobby 26, Lobby 7
+            ((42.3575, -71.0956), (42.3575, -71.0940)), # Parking Lot (no path)
+        ]
+        for loc1, loc2 in pairs:
+            for short in (True, False):
+                expected_path = MapsApp.find_path(self.aux, loc1, loc2, short)
+                result_path = self.tree_path(loc1, loc2, short)
+                if expected_path is None:
+                    self.assertIsNone(result_path)
+                else:
+                    self.assertEqual(len(result_path), len(expected_path), 'Path lengths differ')
+                    self.assertTrue(all(_tuple_close(v1, v2)
+                                        for v1, v2 in zip(result_path, expected_path)))
+
+
+class Test08_ServerCancellation(unittest.TestCase):
+    # a three-node line, so the search needs a few expansions to finish
+    aux = ({1: {2: 25}, 2: {3: 25}, 3: {}},
+           {1: (42.0, -71.0), 2: (42.001, -71.0), 3: (42.002, -71.0)})
+
+    def setUp(self):
+        self.interval = server.DISCONNECT_CHECK_INTERVAL
+        server.DISCONNECT_CHECK_INTERVAL = 1
+        self.client, self.conn = socket.socketpair()
+
+    def tearDown(self):
+        server.DISCONNECT_CHECK_INTERVAL = self.interval
+        self.client.close()
+        self.conn.close()
+
+    def search(self, environ):
+        return MapsApp.find_path(self.aux, (42.0, -71.0), (42.002, -71.0),
+                                 should_stop=server.make_should_stop(environ, None))
+
+    def test_00_connected(self):
+        environ = {'maps.connection': self.conn}
+        self.assertEqual(len(self.search(environ)), 3)
+        self.assertNotIn('maps.cancelled', environ)
+
+    def test_01_client_disconnected(self):
+        environ = {'maps.connection': self.conn}
+        self.client.close()
+        self.assertTrue(server.client_disconnected(environ))
+        self.assertIs(self.search(environ), MapsApp.BUDGET_EXCEEDED)
+        self.assertTrue(environ['maps.cancelled'])
+
+    def test_02_env_limits(self):
+        name = 'MAPS_TEST_LIMIT'
+        try:
+            for value, expected in (('', 7), ('none', None), ('0', None), ('12', 12),
+                                    ('-1', 7), ('lots', 7), ('1.5', 7)):
+                os.environ[name] = value
+                self.assertEqual(server.env_limit(name, 7, int), expected, value)
+            os.environ[name] = '2.5'
+            self.assertEqual(server.env_limit(name, 5.0, float), 2.5)
+        finally:
+            del os.environ[name]
+
+    def test_03_deadline(self):
+        environ = {'maps.connection': self.conn}
+        should_stop = server.make_should_stop(environ, -1)
+        result = MapsApp.find_path(self.aux, (42.0, -71.0), (42.002, -71.0),
+                                   should_stop=should_stop)
+        self.assertIs(result, MapsApp.BUDGET_EXCEEDED)
+        self.assertNotIn('maps.cancelled', environ)
+
+
+class Test09_QueryLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmp.name, 'queries.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_lines(self):
+        with open(self.fname) as f:
+            return [json.loads(line) for line in f]
+
+    def test_00_batches(self):
+        log = server.QueryLog(self.fname, flush_lines=3, flush_seconds=3600)
+        log.append({'n': 0})
+        log.append({'n': 1})
+        self.assertEqual(self.read_lines(), [])
+        log.append({'n': 2})
+        self.assertEqual(self.read_lines(), [{'n': 0}, {'n': 1}, {'n': 2}])
+        log.append({'n': 3})
+        log.close()
+        self.assertEqual([r['n'] for r in self.read_lines()], [0, 1, 2, 3])
+
+    def test_01_flush_if_stale(self):
+        log = server.QueryLog(self.fname, flush_lines=100, flush_seconds=10)
+        log.append({'n': 0})
+        log.flush_if_stale(now=log.first_buffered + 5)
+        self.assertEqual(self.read_lines(), [])
+        log.flush_if_stale(now=log.first_buffered + 10)
+        self.assertEqual(self.read_lines(), [{'n': 0}])
+        log.close()
+
+    def test_02_replay_round_trip(self):
+        log = server.QueryLog(self.fname)
+        log.append({'type': 'fast', 'start': (42.0, -71.0), 'end': (42.1, -71.1),
+                    'dataset': 'mit', 'latency': 0.5})
+        log.close()
+        queries = replay.read_queries(self.fname)
+        self.assertEqual(queries, [{'type': 'fast', 'start': (42.0, -71.0), 'end': (42.1, -71.1),
+                                    'dataset': 'mit', 'latency': 0.5}])
+
+
+class Test10_Replay(unittest.TestCase):
+    def test_00_read_queries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'queries.jsonl')
+            with open(fname, 'w') as f:
+                f.write('{"type": "fast", "start": [1, 2], "end": [3, 4]}\n')
+                f.write('\n')
+                f.write('not json\n')
+                f.write('{"type": "short", "start": [1, 2]}\n')  # no end
+                f.write('{"start": [5, 6], "end": [7, 8], "latency": 0.1}\n')
+                f.write('{"start": [9, 9], "end": [9, 9]}\n')
+            queries = replay.read_queries(fname)
+            self.assertEqual([q['start'] for q in queries], [(1, 2), (5, 6), (9, 9)])
+            self.assertEqual([q['type'] for q in queries], ['fast', 'short', 'short'])
+            self.assertEqual(queries[1]['latency'], 0.1)
+            self.assertEqual(len(replay.read_queries(fname, limit=2)), 2)
+
+    def test_01_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(replay.percentile(values, 50), 50)
+        self.assertEqual(replay.percentile(values, 99), 99)
+        self.assertEqual(replay.percentile(values, 100), 100)
+        self.assertEqual(replay.percentile([7], 90), 7)
+        self.assertIsNone(replay.percentile([], 50))
+
+    def test_02_outcomes(self):
+        queries = [{'type': t, 'start': (0, 0), 'end': (0, 0)}
+                   for t in ('short', 'fast', 'short', 'fast', 'short')]
+
+        def run(query):
+            if query['type'] == 'fast':
+                raise ValueError('boom')
+            return 'ok'
+        latencies, outcomes, elapsed = replay.replay(queries, run, concurrency=2)
+        self.assertEqual(len(latencies), 5)
+        self.assertEqual(outcomes, {'ok': 3, 'error': 2})
+
+    def test_03_queueing_counts_towards_latency(self):
+        # one worker, queries due every 10ms but each taking 50ms: later
+        # queries wait in line, and that wait must show up in their latency
+        queries = [{'type': 'short', 'start': (0, 0), 'end': (0, 0)}] * 5
+        latencies, outcomes, elapsed = replay.replay(
+            queries, lambda query: time.sleep(0.05) or 'ok', concurrency=1, rate=100)
+        self.assertGreater(max(latencies), 0.15)
+
+    def test_04_library_runner_datasets(self):
+        # each query runs on its own dataset, loaded once, or on the default
+        aux = ({1: {2: 25}, 2: {}}, {1: (42.0, -71.0), 2: (42.001, -71.0)})
+        built = []
+
+        def build(nodes_filename, ways_filename):
+            built.append(nodes_filename)
+            return aux
+
+        original = MapsApp.build_auxiliary_structures
+        MapsApp.build_auxiliary_structures = build
+        try:
+            run = replay.make_library_runner('mit')
+            for dataset in ('cambridge', None, 'cambridge', 'mit'):
+                query = {'type': 'short', 'start': (42.0, -71.0), 'end': (42.001, -71.0),
+                         'dataset': dataset}
+                self.assertEqual(run(query), 'ok')
+        finally:
+            MapsApp.build_auxiliary_structures = original
+        self.assertEqual(built, ['resources/cambridge.nodes', 'resources/mit.nodes'])
+
+
+class FakeDataset(server.Dataset):
+    # a dataset whose "graph" is a fixed number of bytes and loads instantly
+    def __init__(self, name, bounds, size, on_load=None):
+        server.Dataset.__init__(self, name, bounds)
+        self.size = size
+        self.on_load = on_load
+
+    def file_bytes(self):
+        return self.size
+
+    def load(self):
+        if self.on_load is not None:
+            self.on_load(self)
+        self.aux = ({}, {})
+        self.graph_size = self.size
+        self.loads += 1
+
+    def unload(self):
+        self.aux = None
+        self.evictions += 1
+
+    def memory(self):
+        return self.size if self.aux is not None else 0
+
+
+def _bounds(minlat, minlon, maxlat, maxlon):
+    return {'minlat': minlat, 'minlon': minlon, 'maxlat': maxlat, 'maxlon': maxlon}
+
+
+class Test11_DatasetRegistry(unittest.TestCase):
+    def setUp(self):
+        self.big = FakeDataset('big', _bounds(0, 0, 10, 10), 100)
+        self.small = FakeDataset('small', _bounds(0, 0, 1, 1), 100)
+        self.other = FakeDataset('other', _bounds(50, 50, 60, 60), 100)
+        self.registry = server.DatasetRegistry([self.big, self.small, self.other],
+                                               memory_ceiling=250)
+
+    def test_00_smallest_containing(self):
+        self.assertIs(self.registry.find((0.5, 0.5), (0.7, 0.2)), self.small)
+        self.assertIs(self.registry.find((0.5, 0.5), (5, 5)), self.big)
+        self.assertIs(self.registry.find((55, 55)), self.other)
+        self.assertIsNone(self.registry.find((0.5, 0.5), (55, 55)))
+
+    def test_01_lazy_loading(self):
+        self.assertEqual([d.loads for d in (self.big, self.small, self.other)], [0, 0, 0])
+        self.registry.acquire(self.small)
+        self.registry.acquire(self.small)
+        self.assertEqual([d.loads for d in (self.big, self.small, self.other)], [0, 1, 0])
+        self.assertEqual(self.registry.memory(), 100)
+
+    def test_02_lru_eviction(self):
+        self.registry.acquire(self.big)
+        self.registry.acquire(self.small)
+        self.registry.acquire(self.big)  # small is now the least recently used
+        self.registry.acquire(self.other)
+        self.assertEqual(list(self.registry.resident), ['big', 'other'])
+        self.assertIsNone(self.small.aux)
+        self.assertEqual(self.small.evictions, 1)
+        self.assertLessEqual(self.registry.memory(), self.registry.memory_ceiling)
+
+    def test_03_evicts_before_loading(self):
+        # the ceiling holds while the new graph is being built, not just after
+        seen = []
+        self.other.on_load = lambda ds: seen.append(self.registry.memory())
+        self.registry.acquire(self.big)
+        self.registry.acquire(self.small)
+        self.registry.acquire(self.other)
+        self.assertEqual(seen, [100])
+        self.assertEqual(list(self.registry.resident), ['small', 'other'])
+
+    def test_04_keeps_dataset_in_use(self):
+        # a dataset bigger than the ceiling on its own is still served
+        self.registry.memory_ceiling = 50
+        self.registry.acquire(self.big)
+        self.registry.acquire(self.small)
+        self.assertEqual(list(self.registry.resident), ['small'])
+        self.assertIsNotNone(self.small.aux)
+
+
+class Test12_HotTargetCache(unittest.TestCase):
+    # a two-way street through five nodes, so every tree has five entries
+    aux = ({1: {2: 25}, 2: {1: 25, 3: 25}, 3: {2: 25, 4: 25}, 4: {3: 25, 5: 25}, 5: {4: 25}},
+           {n: (42.0 + n / 1000, -71.0) for n in range(1, 6)})
+
+    def setUp(self):
+        self.size = hot_targets.tree_size(hot_targets.build_reverse_tree(self.aux, 1))
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault('auto_threshold', 2)
+        cache = hot_targets.HotTargetCache(self.aux, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def request(self, cache, target, times):
+        for _ in range(times):
+            cache.lookup(target)
+        cache.join()
+
+    def test_00_promotion(self):
+        cache = self.make_cache(auto_threshold=3)
+        self.request(cache, 5, 2)
+        self.assertEqual(cache.stats()['trees'], 0)
+        self.request(cache, 5, 1)
+        for short in (True, False):
+            tree = cache.lookup(5, short)
+            self.assertEqual(hot_targets.path_from_tree(self.aux, tree, 1),
+                             MapsApp.find_path(self.aux, (42.001, -71.0), (42.005, -71.0), short))
+        self.assertEqual(cache.stats()['builds'], 2)
+
+    def test_01_evicts_less_popular(self):
+        cache = self.make_cache(memory_budget=4 * self.size)
+        self.request(cache, 1, 3)
+        self.request(cache, 2, 2)
+        self.assertEqual(cache.stats()['trees'], 4)
+        cache.counts[3] = 10  # much more popular than 1 or 2
+        self.request(cache, 3, 1)
+        self.assertEqual(set(cache.trees), {(1, True), (1, False), (3, True), (3, False)})
+        self.assertLessEqual(cache.memory_used, cache.memory_budget)
+        # a new target that is less popular than everything cached is turned away
+        self.request(cache, 4, 2)
+        self.assertNotIn((4, True), cache.trees)
+        self.assertEqual(cache.stats()['rejected'], 1)
+        # the evicted target comes back once it beats the least popular one
+        self.request(cache, 2, 1)
+        self.assertNotIn(2, cache.auto)
+        self.request(cache, 2, 1)
+        self.assertEqual(set(cache.trees), {(2, True), (2, False), (3, True), (3, False)})
+
+    def test_02_configured_targets_kept(self):
+        cache = self.make_cache(targets=[1], memory_budget=self.size)
+        cache.join()
+        self.assertEqual(set(cache.trees), {(1, True), (1, False)})
+        cache.counts[2] = 100
+        self.request(cache, 2, 1)
+        self.assertEqual(set(cache.trees), {(1, True), (1, False)})
+
+    def test_03_set_graph(self):
+        cache = self.make_cache(targets=[1])
+        cache.join()
+        moved = (self.aux[0], {n: (43.0 + n / 1000, -71.0) for n in range(1, 6)})
+        cache.set_graph(moved)
+        self.assertEqual(cache.stats()['trees'], 0)
+        cache.join()
+        tree = cache.lookup(1, True)
+        self.assertEqual(hot_targets.path_from_tree(moved, tree, 3),
+                         [(43.003, -71.0), (43.002, -71.0), (43.001, -71.0)])
+
+    def test_04_evicts_whole_targets(self):
+        # two small streets and a long one: the long street's trees only fit
+        # once both small targets are gone
+        web = {i: {j: 25 for j in (i - 1, i + 1) if 0 <= j < 50} for i in range(50)}
+        web.update({100: {101: 25}, 101: {100: 25}, 200: {201: 25}, 201: {200: 25}})
+        coords = {n: (42.0 + n / 10000, -71.0) for n in web}
+        aux = (web, coords)
+        small = hot_targets.tree_size(hot_targets.build_reverse_tree(aux, 100))
+        large = hot_targets.tree_size(hot_targets.build_reverse_tree(aux, 0))
+        cache = hot_targets.HotTargetCache(aux, memory_budget=2 * large, auto_threshold=2)
+        self.caches.append(cache)
+        self.request(cache, 100, 2)
+        self.request(cache, 200, 2)
+        self.assertEqual(cache.memory_used, 4 * small)
+        cache.counts[0] = 10
+        self.request(cache, 0, 1)
+        self.assertEqual(set(cache.trees), {(0, True), (0, False)})
+        self.assertEqual(cache.memory_used, 2 * large)
+        self.assertTrue(cache.worker.is_alive())
+
+    def test_05_rejects_before_evicting(self):
+        # the long street's first tree would fit after evicting target 100,
+        # but the pair never fits, so nothing is evicted for it
+        web = {i: {j: 25 for j in (i - 1, i + 1) if 0 <= j < 50} for i in range(50)}
+        web.update({100: {101: 25}, 101: {100: 25}, 200: {201: 25}, 201: {200: 25}})
+        coords = {n: (42.0 + n / 10000, -71.0) for n in web}
+        aux = (web, coords)
+        small = hot_targets.tree_size(hot_targets.build_reverse_tree(aux, 100))
+        large = hot_targets.tree_size(hot_targets.build_reverse_tree(aux, 0))
+        cache = hot_targets.HotTargetCache(aux, memory_budget=4 * small + large - 1,
+                                           auto_threshold=2)
+        self.caches.append(cache)
+        self.request(cache, 100, 2)
+        cache.counts[200] = 9
+        self.request(cache, 200, 1)
+        cache.counts[0] = 4
+        self.request(cache, 0, 1)
+        self.assertEqual(set(cache.trees), {(100, True), (100, False), (200, True), (200, False)})
+        self.assertEqual(cache.stats()['rejected'], 1)
+        self.assertEqual(cache.stats()['builds'], 4)
+
+    def test_06_close_stops_builds(self):
+        # a long street with many configured targets, so builds are queued
+        n = 2000
+        web = {i: {j: 25 for j in (i - 1, i + 1) if 0 <= j < n} for i in range(n)}
+        coords = {i: (42.0 + i / 10000, -71.0) for i in range(n)}
+        cache = hot_targets.HotTargetCache((web, coords), targets=range(0, n, 50))
+        cache.close()
+        builds = cache.stats()['builds']
+        cache.worker.join(30)
+        self.assertFalse(cache.worker.is_alive())
+        self.assertEqual(cache.stats()['builds'], builds)
+        self.assertLess(builds, 2 * len(range(0, n, 50)))
+
+    def test_07_counts_decay(self):
+        cache = self.make_cache(auto_threshold=1000, max_tracked=10)
+        cache.demoted.update({0, 50})
+        for target in range(100):
+            cache.lookup(target)
+        self.assertLessEqual(len(cache.counts), 10)
+        self.assertLessEqual(cache.demoted, set(cache.counts))
+
+
 if __name__ == '__main__':
     res = unittest.main(verbosity=3, exit=False)